@@ -1,48 +1,103 @@
+import os
+import io
+import base64
 import streamlit as st
 import xarray as xr
+import dask
+import numpy as np
+import pandas as pd
+import folium
 import leafmap.foliumap as leafmap
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from convert_to_zarr import ensure_zarr
+from grid_utils import MAX_TABLE_ROWS, grid_bounds, image_bounds, regular_grid, nearest_ij
 
 @st.cache_resource
 def load_data():
-    ds = xr.open_dataset("data/sample.nc", engine="netcdf4")
-    return ds
+    # Open lazily from Zarr so a point query touches one chunk rather than every time slice
+    ds = xr.open_zarr(ensure_zarr("data/sample.nc"))
+    # In-memory (lat, lon, time) copy so each point series is one contiguous read
+    pr_pt = ds['pr'].transpose('lat', 'lon', 'time').load()
+    return ds, pr_pt, regular_grid(ds)
 
-try:
-    import localtileserver
-    st.write("localtileserver is installed!")
-except ImportError:
-    st.error("localtileserver is NOT installed!")
+@st.cache_resource
+def load_bounds():
+    """Coordinate extent and map center of the loaded dataset, computed once"""
+    return grid_bounds(load_data()[0])
+
+@st.cache_data(persist="disk", show_spinner=False)
+def build_mean_overlay(nc_path: str, var: str, mtime: float):
+    """Render the time-mean of `var` to a PNG data URL and its cell-edge bounds, once per source file version"""
+    ds = xr.open_zarr(ensure_zarr(nc_path))
+    # Average over time, evaluated once; spatial chunks (full time) reduce on every core
+    with dask.config.set(scheduler='threads', num_workers=os.cpu_count()):
+        avg_map = ds[var].mean(dim='time').compute()
+
+    # North-up rows, encoded in memory (no GeoTIFF or tile server round-trip)
+    arr = avg_map.sortby('lat', ascending=False).transpose('lat', 'lon').values
+    png = io.BytesIO()
+    plt.imsave(png, arr, cmap='viridis', vmin=np.nanmin(arr), vmax=np.nanmax(arr), format='png')
+    return "data:image/png;base64," + base64.b64encode(png.getvalue()).decode(), image_bounds(avg_map)
+
+@st.cache_data(max_entries=256)
+def ts_csv(iy: int, ix: int) -> bytes:
+    """CSV bytes for one grid cell, encoded only when the selection changes"""
+    ts = load_data()[1].isel(lat=iy, lon=ix)
+    return pd.DataFrame({'time': ts['time'].values, 'pr': ts.values}).to_csv(index=False).encode()
+
+@st.cache_data(max_entries=64)
+def make_ts_png(iy: int, ix: int, lat: float, lon: float) -> bytes:
+    """Time series chart for one grid cell as PNG bytes, rendered once per selection
+
+    Only the bytes are shared between sessions; each render uses its own Figure.
+    """
+    ts = load_data()[1].isel(lat=iy, lon=ix)
+    actual_lat = float(ts.lat.values)
+    actual_lon = float(ts.lon.values)
+
+    # Detached from pyplot so the figure is not tracked by the global figure manager
+    fig = Figure(figsize=(12, 6))
+    ax = fig.subplots()
+    ax.plot(ts['time'].values, ts.values, linewidth=2, color='blue')
+    ax.set_title(f"Extreme Rainfall Time Series\nSelected: ({lat:.2f}, {lon:.2f}) → Actual: ({actual_lat:.2f}, {actual_lon:.2f})")
+    ax.set_ylabel("Extreme Rainfall (mm)")
+    ax.set_xlabel("Time")
+    ax.grid(True, alpha=0.3)
+    ax.tick_params(axis='x', labelrotation=45)
+    fig.tight_layout()
+    png = io.BytesIO()
+    fig.savefig(png, format='png', dpi=100)
+    return png.getvalue()
 
 st.title("Extreme Rainfall Explorer")
 st.write("Use the manual input below to select coordinates and view rainfall time series.")
 
-ds = load_data()
-
-# Calculate spatial mean for map
-avg_map = ds['pr'].mean(dim='time')  # Average over time
+ds, pr_pt, grid = load_data()
+bounds = load_bounds()
 
-# Set CRS and spatial dims explicitly
-avg_map.rio.set_spatial_dims(x_dim="lon", y_dim="lat", inplace=True)
-avg_map.rio.write_crs("EPSG:4326", inplace=True)
-
-# Export to GeoTIFF
-avg_map.rio.to_raster("temp.tif")
+# Spatial mean overlay for map (cached across reruns and restarts)
+overlay_url, overlay_bounds = build_mean_overlay("data/sample.nc", "pr", os.path.getmtime("data/sample.nc"))
 
 # Create map
-center_lat = float((ds.lat.min() + ds.lat.max()) / 2)
-center_lon = float((ds.lon.min() + ds.lon.max()) / 2)
+center_lat = bounds.center_lat
+center_lon = bounds.center_lon
 
 m = leafmap.Map(center=[center_lat, center_lon], zoom=5)
-m.add_raster("temp.tif", layer_name="Mean Extreme Precip")
+folium.raster_layers.ImageOverlay(
+    image=overlay_url,
+    bounds=overlay_bounds,
+    opacity=0.7,
+    name="Mean Extreme Precip"
+).add_to(m)
 
 # Display the map
 st.subheader("Rainfall Data Visualization")
 m.to_streamlit(height=600)
 
 # Show data bounds
-st.info(f"Data coverage: Latitude {ds.lat.min().values:.2f}° to {ds.lat.max().values:.2f}°, "
-        f"Longitude {ds.lon.min().values:.2f}° to {ds.lon.max().values:.2f}°")
+st.info(f"Data coverage: Latitude {bounds.lat_min:.2f}° to {bounds.lat_max:.2f}°, "
+        f"Longitude {bounds.lon_min:.2f}° to {bounds.lon_max:.2f}°")
 
 # Initialize session state for clicked coordinates
 if 'clicked_coords' not in st.session_state:
@@ -52,13 +107,9 @@ if 'clicked_coords' not in st.session_state:
 st.subheader("Manual Coordinate Input")
 col1, col2, col3 = st.columns([1, 1, 1])
 with col1:
-    lat_min, lat_max = float(ds.lat.min()), float(ds.lat.max())
-    lat_default = (lat_min + lat_max) / 2
-    manual_lat = st.number_input("Latitude", value=lat_default, min_value=lat_min, max_value=lat_max, key="manual_lat")
+    manual_lat = st.number_input("Latitude", value=bounds.center_lat, min_value=bounds.lat_min, max_value=bounds.lat_max, key="manual_lat")
 with col2:
-    lon_min, lon_max = float(ds.lon.min()), float(ds.lon.max())
-    lon_default = (lon_min + lon_max) / 2
-    manual_lon = st.number_input("Longitude", value=lon_default, min_value=lon_min, max_value=lon_max, key="manual_lon")
+    manual_lon = st.number_input("Longitude", value=bounds.center_lon, min_value=bounds.lon_min, max_value=bounds.lon_max, key="manual_lon")
 with col3:
     st.write("")  # Empty space for alignment
     st.write("")  # Empty space for alignment
@@ -69,13 +120,9 @@ with col3:
 st.subheader("Select Coordinates for Time Series")
 col1, col2, col3 = st.columns([1, 1, 1])
 with col1:
-    lat_min, lat_max = float(ds.lat.min()), float(ds.lat.max())
-    lat_default = (lat_min + lat_max) / 2
-    selected_lat = st.number_input("Latitude", value=lat_default, min_value=lat_min, max_value=lat_max, key="lat_input")
+    selected_lat = st.number_input("Latitude", value=bounds.center_lat, min_value=bounds.lat_min, max_value=bounds.lat_max, key="lat_input")
 with col2:
-    lon_min, lon_max = float(ds.lon.min()), float(ds.lon.max())
-    lon_default = (lon_min + lon_max) / 2
-    selected_lon = st.number_input("Longitude", value=lon_default, min_value=lon_min, max_value=lon_max, key="lon_input")
+    selected_lon = st.number_input("Longitude", value=bounds.center_lon, min_value=bounds.lon_min, max_value=bounds.lon_max, key="lon_input")
 with col3:
     st.write("")  # Empty space for alignment
     st.write("")  # Empty space for alignment
@@ -89,39 +136,40 @@ if st.session_state.clicked_coords:
     
     try:
         # Select the nearest point
-        ts = ds['pr'].sel(lat=lat, lon=lon, method='nearest')
+        iy, ix = nearest_ij(lat, lon, grid)
+        ts = pr_pt.isel(lat=iy, lon=ix)
         actual_lat = float(ts.lat.values)
         actual_lon = float(ts.lon.values)
         
         # Convert to dataframe for plotting
-        df = ts.to_dataframe().reset_index()
-
-        # Create the time series plot
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.plot(df['time'], df['pr'], linewidth=2, color='blue')
-        ax.set_title(f"Extreme Rainfall Time Series\nSelected: ({lat:.2f}, {lon:.2f}) → Actual: ({actual_lat:.2f}, {actual_lon:.2f})")
-        ax.set_ylabel("Extreme Rainfall (mm)")
-        ax.set_xlabel("Time")
-        ax.grid(True, alpha=0.3)
-        plt.xticks(rotation=45)
-        plt.tight_layout()
-        st.pyplot(fig)
+        df = pd.DataFrame({'time': ts['time'].values, 'pr': ts.values})
+
+        # Time series plot (cached per selection)
+        st.image(make_ts_png(iy, ix, lat, lon))
         
-        # Display statistics
+        # Display statistics (NaN-skipping reductions on the raw numpy buffer; ddof=1 matches pandas)
+        arr = ts.values
         st.subheader("Statistics")
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Maximum", f"{df['pr'].max():.2f} mm")
+            st.metric("Maximum", f"{np.nanmax(arr):.2f} mm")
         with col2:
-            st.metric("Minimum", f"{df['pr'].min():.2f} mm")
+            st.metric("Minimum", f"{np.nanmin(arr):.2f} mm")
         with col3:
-            st.metric("Mean", f"{df['pr'].mean():.2f} mm")
+            st.metric("Mean", f"{np.nanmean(arr):.2f} mm")
         with col4:
-            st.metric("Std Dev", f"{df['pr'].std():.2f} mm")
+            st.metric("Std Dev", f"{np.nanstd(arr, ddof=1):.2f} mm")
             
         # Show data table
         with st.expander("View Raw Data"):
-            st.dataframe(df)
+            st.dataframe(df.head(MAX_TABLE_ROWS))
+            st.caption(f"Showing {min(MAX_TABLE_ROWS, len(df))} of {len(df)} rows")
+            st.download_button(
+                label="Download Full Data (CSV)",
+                data=ts_csv(iy, ix),
+                file_name=f"rainfall_data_{actual_lat:.2f}_{actual_lon:.2f}.csv",
+                mime="text/csv"
+            )
             
     except Exception as e:
         st.error(f"Error generating time series: {str(e)}")
@@ -1,10 +1,14 @@
+import os
 import streamlit as st
 import xarray as xr
+import dask
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
 import folium
+from folium.plugins import FastMarkerCluster
 from streamlit_folium import st_folium
+from grid_utils import MAX_TABLE_ROWS, grid_bounds, nearest_index
 
 st.title("🌧️ Flood Storm Dashboard - Debug Version")
 
@@ -12,11 +16,24 @@ st.title("🌧️ Flood Storm Dashboard - Debug Version")
 @st.cache_resource
 def load_data():
     try:
-        ds = xr.open_dataset("data/sample.nc", engine="netcdf4")
+        # Open lazily with dask so reductions stream through one time block at a time
+        ds = xr.open_dataset("data/sample.nc", engine="h5netcdf",
+                             chunks={"time": 365, "lat": -1, "lon": -1})
         return ds, None
     except Exception as e:
         return None, str(e)
 
+@st.cache_resource
+def load_bounds():
+    return grid_bounds(load_data()[0])
+
+@st.cache_resource
+def load_pr_range():
+    """Raw precipitation min/max, evaluated together in one pass over the dask blocks"""
+    pr = load_data()[0]['pr']
+    lo, hi = dask.compute(pr.min().data, pr.max().data)
+    return float(lo), float(hi)
+
 ds, error = load_data()
 
 if error:
@@ -27,6 +44,8 @@ if ds is None:
     st.error("No data loaded")
     st.stop()
 
+bounds = load_bounds()
+
 # Display dataset information
 st.subheader("Dataset Information")
 col1, col2 = st.columns(2)
@@ -40,33 +59,66 @@ with col1:
 with col2:
     st.write("**Data Ranges:**")
     if 'pr' in ds.data_vars:
-        pr_data = ds['pr']
-        st.write(f"- Precipitation: {pr_data.min().values:.6f} to {pr_data.max().values:.6f}")
+        pr_min, pr_max = load_pr_range()
+        st.write(f"- Precipitation: {pr_min:.6f} to {pr_max:.6f}")
     if 'time' in ds.coords:
-        st.write(f"- Time: {ds.time.min().values} to {ds.time.max().values}")
+        # Time is monotonic, so the ends of the coordinate are its range
+        time_first, time_last = ds.time.values[[0, -1]]
+        st.write(f"- Time: {time_first} to {time_last}")
     if 'lat' in ds.coords:
-        st.write(f"- Latitude: {ds.lat.min().values:.2f} to {ds.lat.max().values:.2f}")
+        st.write(f"- Latitude: {bounds.lat_min:.2f} to {bounds.lat_max:.2f}")
     if 'lon' in ds.coords:
-        st.write(f"- Longitude: {ds.lon.min().values:.2f} to {ds.lon.max().values:.2f}")
+        st.write(f"- Longitude: {bounds.lon_min:.2f} to {bounds.lon_max:.2f}")
 
-# Process yearly data
-@st.cache_resource
+# Process yearly data (keyed on the source file rather than the Dataset object)
+@st.cache_data(hash_funcs={xr.Dataset: lambda d: d.encoding.get('source', id(d))})
 def process_yearly_data(ds):
     try:
         # Convert time to datetime if needed
         if not pd.api.types.is_datetime64_any_dtype(ds.time):
             ds['time'] = pd.to_datetime(ds.time.values)
         
-        # Group by year and calculate maximum
-        yearly_max = ds.groupby('time.year').max('time')
-        
-        # Calculate mean across years for mapping
-        yearly_mean = yearly_max['pr'].mean(dim='year')
-        
-        return yearly_max, yearly_mean, None
+        # Group by year and calculate maximum per spatial block, keeping time whole so
+        # flox reduces each block in one task; float32 halves the bytes per block
+        dsc = ds.chunk({'time': -1, 'lat': 64, 'lon': 64})
+        dsc = dsc.assign(pr=dsc['pr'].astype('float32'))
+        # Spread the per-block maxima over every core
+        with dask.config.set(scheduler='threads', num_workers=os.cpu_count()):
+            yearly_max = dsc.groupby('time.year').max('time', engine="flox", method="cohorts").persist()
+            
+            # Calculate mean across years for mapping
+            yearly_mean = yearly_max['pr'].mean(dim='year')
+            
+            # Materialize so the cached results are numpy-backed, not dask graphs
+            return yearly_max.compute(), yearly_mean.compute(), None
     except Exception as e:
         return None, None, str(e)
 
+@st.cache_data(max_entries=256)
+def get_cell_series(_yearly_ds, grid_lat: float, grid_lon: float) -> pd.DataFrame:
+    """Yearly series of one grid cell, keyed on its snapped coordinates so repeat clicks hit the cache"""
+    ts = _yearly_ds['pr'].sel(lat=grid_lat, lon=grid_lon)
+    return pd.DataFrame({'year': ts['year'].values, 'pr': ts.values})
+
+@st.cache_data(max_entries=256)
+def cell_csv(_yearly_ds, grid_lat: float, grid_lon: float) -> bytes:
+    return get_cell_series(_yearly_ds, grid_lat, grid_lon).to_csv(index=False).encode()
+
+@st.cache_resource
+def load_grid_coords():
+    """Ascending yearly-grid coordinates as numpy arrays, for index-space snapping"""
+    yearly_ds = process_yearly_data(load_data()[0])[0]
+    return np.sort(yearly_ds.lat.values), np.sort(yearly_ds.lon.values)
+
+def session_figure(name, figsize):
+    """Figure/Axes pair kept in session state and cleared for reuse on every draw"""
+    if name not in st.session_state:
+        fig = Figure(figsize=figsize)
+        st.session_state[name] = (fig, fig.add_subplot(111))
+    fig, ax = st.session_state[name]
+    ax.cla()
+    return fig, ax
+
 yearly_ds, yearly_mean, yearly_error = process_yearly_data(ds)
 
 if yearly_error:
@@ -79,61 +131,70 @@ col1, col2 = st.columns(2)
 with col1:
     st.write("**Yearly Data:**")
     st.write(f"- Shape: {dict(yearly_ds.dims)}")
-    st.write(f"- Years: {yearly_ds.year.min().values} to {yearly_ds.year.max().values}")
+    year_first, year_last = yearly_ds.year.values[[0, -1]]
+    st.write(f"- Years: {year_first} to {year_last}")
 
 with col2:
     st.write("**Yearly Mean for Mapping:**")
     st.write(f"- Shape: {dict(yearly_mean.dims)}")
-    st.write(f"- Range: {yearly_mean.min().values:.6f} to {yearly_mean.max().values:.6f}")
+    ym = yearly_mean.values
+    st.write(f"- Range: {np.nanmin(ym):.6f} to {np.nanmax(ym):.6f}")
 
 # Create map with data overlay
 st.subheader("Interactive Map")
 
 # Get map bounds
-center_lat = float((ds.lat.min() + ds.lat.max()) / 2)
-center_lon = float((ds.lon.min() + ds.lon.max()) / 2)
+center_lat = bounds.center_lat
+center_lon = bounds.center_lon
 
 # Create basic folium map
 m = folium.Map(location=[center_lat, center_lon], zoom_start=6)
 
 # Add data bounds rectangle
-bounds = [
-    [float(ds.lat.min()), float(ds.lon.min())],
-    [float(ds.lat.max()), float(ds.lon.max())]
+rect_bounds = [
+    [bounds.lat_min, bounds.lon_min],
+    [bounds.lat_max, bounds.lon_max]
 ]
 
 folium.Rectangle(
-    bounds=bounds,
+    bounds=rect_bounds,
     color='red',
     fill=True,
     fillColor='blue',
     fillOpacity=0.3,
-    popup=f'Data Coverage Area<br>Lat: {ds.lat.min().values:.2f} to {ds.lat.max().values:.2f}<br>Lon: {ds.lon.min().values:.2f} to {ds.lon.max().values:.2f}'
+    popup=f'Data Coverage Area<br>Lat: {bounds.lat_min:.2f} to {bounds.lat_max:.2f}<br>Lon: {bounds.lon_min:.2f} to {bounds.lon_max:.2f}'
 ).add_to(m)
 
 # Add grid points as markers (sample some points)
-lat_points = np.linspace(ds.lat.min(), ds.lat.max(), 5)
-lon_points = np.linspace(ds.lon.min(), ds.lon.max(), 5)
+lat_points = np.linspace(bounds.lat_min, bounds.lat_max, 5)
+lon_points = np.linspace(bounds.lon_min, bounds.lon_max, 5)
 
-for lat in lat_points:
-    for lon in lon_points:
-        # Get the mean value at this point
-        try:
-            value = yearly_mean.sel(lat=lat, lon=lon, method='nearest').values
-            folium.CircleMarker(
-                location=[float(lat), float(lon)],
-                radius=5,
-                popup=f'Lat: {lat:.2f}, Lon: {lon:.2f}<br>Mean: {value:.6f}',
-                color='green',
-                fill=True,
-                fillColor='green',
-                fillOpacity=0.7
-            ).add_to(m)
-        except:
-            pass
+# Look up all 25 grid points in one vectorized selection
+lat_grid, lon_grid = np.meshgrid(lat_points, lon_points, indexing='ij')
+lat_da = xr.DataArray(lat_grid.ravel(), dims='pt')
+lon_da = xr.DataArray(lon_grid.ravel(), dims='pt')
+try:
+    values = yearly_mean.sel(lat=lat_da, lon=lon_da, method='nearest').values
+except Exception:
+    values = []
+
+# Ship markers as one JS array; the callback builds each circle in the browser
+marker_data = [[float(lat), float(lon), float(value)]
+               for lat, lon, value in zip(lat_da.values, lon_da.values, values)]
+marker_callback = """
+function (row) {
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]),
+        {radius: 5, color: 'green', fill: true, fillColor: 'green', fillOpacity: 0.7});
+    marker.bindPopup('Lat: ' + row[0].toFixed(2) + ', Lon: ' + row[1].toFixed(2) +
+                     '<br>Mean: ' + row[2].toFixed(6));
+    return marker;
+};
+"""
+FastMarkerCluster(marker_data, callback=marker_callback, name='Grid Points').add_to(m)
 
 # Display the map
-map_data = st_folium(m, height=500, width=800)
+map_data = st_folium(m, height=500, width=800,
+                     returned_objects=['last_clicked'], key='debug_map')
 
 # Handle map clicks
 st.subheader("Click Analysis")
@@ -145,32 +206,38 @@ if map_data and map_data['last_clicked']:
     st.success(f"Clicked at: Lat {clicked_lat:.2f}, Lon {clicked_lon:.2f}")
     
     # Check if click is within bounds
-    if (ds.lat.min() <= clicked_lat <= ds.lat.max() and 
-        ds.lon.min() <= clicked_lon <= ds.lon.max()):
+    if (bounds.lat_min <= clicked_lat <= bounds.lat_max and 
+        bounds.lon_min <= clicked_lon <= bounds.lon_max):
         
         try:
-            # Get yearly time series at clicked location
-            ts = yearly_ds['pr'].sel(lat=clicked_lat, lon=clicked_lon, method='nearest')
-            actual_lat = float(ts.lat.values)
-            actual_lon = float(ts.lon.values)
+            # Snap the click to the nearest grid cell; its series is cached per cell
+            lats, lons = load_grid_coords()
+            actual_lat = float(lats[nearest_index(lats, clicked_lat)])
+            actual_lon = float(lons[nearest_index(lons, clicked_lon)])
             
             st.info(f"Nearest grid point: Lat {actual_lat:.2f}, Lon {actual_lon:.2f}")
             
-            # Convert to dataframe
-            df = ts.to_dataframe().reset_index()
+            df = get_cell_series(yearly_ds, actual_lat, actual_lon)
             
             # Plot time series
-            fig, ax = plt.subplots(figsize=(10, 6))
+            fig, ax = session_figure('fig_ts', (10, 6))
             ax.plot(df['year'], df['pr'], 'o-', linewidth=2, markersize=6)
             ax.set_title(f'Yearly Maximum Precipitation Time Series\nLocation: {actual_lat:.2f}, {actual_lon:.2f}')
             ax.set_xlabel('Year')
             ax.set_ylabel('Precipitation (kg m⁻² s⁻¹)')
             ax.grid(True, alpha=0.3)
-            st.pyplot(fig)
+            st.pyplot(fig, clear_figure=False)
             
             # Show data table
             st.subheader("Data Table")
-            st.dataframe(df)
+            st.dataframe(df.head(MAX_TABLE_ROWS))
+            st.caption(f"Showing {min(MAX_TABLE_ROWS, len(df))} of {len(df)} rows")
+            st.download_button(
+                label="Download Full Data (CSV)",
+                data=cell_csv(yearly_ds, actual_lat, actual_lon),
+                file_name=f"yearly_precip_{actual_lat:.2f}_{actual_lon:.2f}.csv",
+                mime="text/csv"
+            )
             
         except Exception as e:
             st.error(f"Error processing click: {str(e)}")
@@ -186,35 +253,34 @@ col1, col2, col3 = st.columns(3)
 with col1:
     manual_lat = st.number_input("Latitude", 
                                 value=center_lat, 
-                                min_value=float(ds.lat.min()), 
-                                max_value=float(ds.lat.max()))
+                                min_value=bounds.lat_min, 
+                                max_value=bounds.lat_max)
 with col2:
     manual_lon = st.number_input("Longitude", 
                                 value=center_lon, 
-                                min_value=float(ds.lon.min()), 
-                                max_value=float(ds.lon.max()))
+                                min_value=bounds.lon_min, 
+                                max_value=bounds.lon_max)
 with col3:
     st.write("")  # spacer
     if st.button("Generate Time Series"):
         try:
-            # Get yearly time series at manual location
-            ts = yearly_ds['pr'].sel(lat=manual_lat, lon=manual_lon, method='nearest')
-            actual_lat = float(ts.lat.values)
-            actual_lon = float(ts.lon.values)
+            # Snap the input to the nearest grid cell; its series is cached per cell
+            lats, lons = load_grid_coords()
+            actual_lat = float(lats[nearest_index(lats, manual_lat)])
+            actual_lon = float(lons[nearest_index(lons, manual_lon)])
             
             st.success(f"Generated time series for: Lat {actual_lat:.2f}, Lon {actual_lon:.2f}")
             
-            # Convert to dataframe
-            df = ts.to_dataframe().reset_index()
+            df = get_cell_series(yearly_ds, actual_lat, actual_lon)
             
             # Plot time series
-            fig, ax = plt.subplots(figsize=(10, 6))
+            fig, ax = session_figure('fig_ts', (10, 6))
             ax.plot(df['year'], df['pr'], 'o-', linewidth=2, markersize=6)
             ax.set_title(f'Yearly Maximum Precipitation Time Series\nLocation: {actual_lat:.2f}, {actual_lon:.2f}')
             ax.set_xlabel('Year')
             ax.set_ylabel('Precipitation (kg m⁻² s⁻¹)')
             ax.grid(True, alpha=0.3)
-            st.pyplot(fig)
+            st.pyplot(fig, clear_figure=False)
             
             # Show statistics
             st.subheader("Statistics")
@@ -1,129 +1,185 @@
+import os
+import io
+import importlib.util
+import base64
 import streamlit as st
 import xarray as xr
-import leafmap.foliumap as leafmap
-import matplotlib.pyplot as plt
+import altair as alt
 import folium
 from streamlit_folium import st_folium
 import numpy as np
 import pandas as pd
 from datetime import datetime
+from convert_to_zarr import ensure_zarr
+from grid_utils import MAX_TABLE_ROWS, grid_bounds, image_bounds, regular_grid, nearest_ij, coarsen_for_display, cell_stats, within
 
-@st.cache_resource
-def load_data():
-    ds = xr.open_dataset("data/sample.nc", engine="netcdf4")
-    # Convert time to datetime
-    ds['time'] = pd.to_datetime(ds.time.values)
-    return ds
+def yearly_max_segments(ds, years):
+    """Yearly maximum over contiguous year runs of a time-sorted dataset, numpy only"""
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(years)) + 1))
+    pr = ds['pr'].transpose('time', 'lat', 'lon')
+    # fmax skips NaN like xarray's max does
+    data = np.fmax.reduceat(pr.values, starts, axis=0)
+    return xr.Dataset({'pr': (('year', 'lat', 'lon'), data)},
+                      coords={'year': years[starts], 'lat': pr.lat.values, 'lon': pr.lon.values})
 
-@st.cache_resource
-def prepare_yearly_data(ds):
-    # Calculate yearly maximum values (extreme rainfall)
-    yearly_max = ds.groupby('time.year').max('time')
+def prepare_yearly_data(ds, years):
+    # Calculate yearly maximum values (extreme rainfall), grouping on the precomputed
+    # year array instead of the time.year accessor
+    has_flox = importlib.util.find_spec("flox") is not None
+    if not has_flox and np.all(np.diff(years) >= 0):
+        yearly_max = yearly_max_segments(ds, years)
+    else:
+        year = xr.DataArray(years, dims='time', name='year')
+        # flox tree-reduces over chunks; without it xarray's default groupby is used
+        flox_kwargs = {'engine': "flox", 'method': "cohorts"} if has_flox else {}
+        yearly_max = ds.groupby(year).max('time', **flox_kwargs).compute()
     # Also calculate the overall mean across all years for mapping
     yearly_mean = yearly_max['pr'].mean(dim='year')
     return yearly_max, yearly_mean
 
-try:
-    import localtileserver
-    st.write("localtileserver is installed!")
-except ImportError:
-    st.error("localtileserver is NOT installed!")
+@st.cache_resource
+def load_data():
+    """Load the dataset and its yearly reductions as one zero-argument cached tuple
 
-st.title("🌧️ Extreme Rainfall Explorer")
-st.write("**Click anywhere on the map** to view rainfall time series at that location.")
+    Keeping the yearly step inside the loader means no Dataset is ever hashed as a
+    cache argument.
+    """
+    # Open the chunked Zarr store lazily; the store has no packed values to decode
+    ds = xr.open_dataset(ensure_zarr("data/sample.nc"), engine="zarr", consolidated=True,
+                         chunks={"time": -1, "lat": 64, "lon": 64}, mask_and_scale=False)
+    # float32 halves the bytes moved by every reduction, selection and raster write
+    ds['pr'] = ds['pr'].astype('float32')
+    # Times are decoded on open; only fall back to pandas for non-datetime64 calendars
+    if not np.issubdtype(ds.time.dtype, np.datetime64):
+        ds['time'] = pd.to_datetime(ds.time.values)
+    # Year of every timestamp, derived once from the datetime64 values
+    years = ds.time.values.astype('datetime64[Y]').astype(int) + 1970
+    yearly_max, yearly_mean = prepare_yearly_data(ds, years)
+    return ds, yearly_max, yearly_mean
 
-ds = load_data()
-yearly_ds, yearly_mean_map = prepare_yearly_data(ds)
+@st.cache_resource
+def load_bounds():
+    return grid_bounds(load_data()[0])
 
-# Use the yearly mean for the map display
-avg_map = yearly_mean_map
+@st.cache_resource
+def load_grid():
+    return regular_grid(load_data()[0])
 
-# Set CRS and spatial dims explicitly
-avg_map.rio.set_spatial_dims(x_dim="lon", y_dim="lat", inplace=True)
-avg_map.rio.write_crs("EPSG:4326", inplace=True)
+@st.cache_resource
+def load_grid_stats():
+    """Trend coefficients and summary statistics for every grid cell, computed once"""
+    yearly_pr = load_data()[1]['pr'].transpose('year', 'lat', 'lon')
+    nlat, nlon = yearly_pr.sizes['lat'], yearly_pr.sizes['lon']
+    stats = cell_stats(yearly_pr.year.values, yearly_pr.values.reshape(yearly_pr.sizes['year'], -1))
+    return {name: values.reshape(nlat, nlon) for name, values in stats.items()}
 
-# Export to GeoTIFF
-try:
-    avg_map.rio.to_raster("temp_yearly.tif")
-    st.success("✅ GeoTIFF file created successfully!")
-except Exception as e:
-    st.error(f"❌ Error creating GeoTIFF: {str(e)}")
-    # Try alternative approach
-    try:
-        avg_map.to_netcdf("temp_yearly.nc")
-        st.info("💡 Created NetCDF file as fallback")
-    except Exception as e2:
-        st.error(f"❌ Error creating NetCDF: {str(e2)}")
+@st.cache_data(max_entries=256)
+def get_ts_df(iy: int, ix: int) -> pd.DataFrame:
+    """Yearly maximum series at one grid cell, cached so revisited points are instant"""
+    yearly_max = load_data()[1]
+    ts = yearly_max['pr'].isel(lat=iy, lon=ix)
+    return pd.DataFrame({'year': ts['year'].values, 'pr': ts.values})
 
-# Create leafmap with the yearly raster overlay
-center_lat = float((ds.lat.min() + ds.lat.max()) / 2)
-center_lon = float((ds.lon.min() + ds.lon.max()) / 2)
+@st.cache_data(max_entries=256)
+def ts_csv(iy: int, ix: int) -> bytes:
+    return get_ts_df(iy, ix).to_csv(index=False).encode()
 
-# Use leafmap for proper raster display
-m = leafmap.Map(center=[center_lat, center_lon], zoom=6)
+@st.cache_data(persist="disk", show_spinner=False)
+def build_yearly_overlay(var: str, mtime: float):
+    """Render the mean of yearly maxima of `var` to a PNG data URL and its cell-edge bounds,
+    once per source file version"""
+    # Imported here so matplotlib only loads when the overlay cache is cold
+    import matplotlib.image as mpimg
 
-# Try to add raster layer
-try:
-    m.add_raster("temp_yearly.tif", layer_name="Mean Yearly Max Extreme Precip", opacity=0.8, colormap="viridis")
-    st.success("✅ Raster layer added to map!")
-except Exception as e:
-    st.error(f"❌ Error adding raster layer: {str(e)}")
-    # Try adding a simple basemap layer
-    try:
-        # Create a simple visualization using the data bounds
-        import folium
-        from folium import plugins
-        
-        # Create basic folium map
-        m = folium.Map(location=[center_lat, center_lon], zoom_start=6)
-        
+    yearly_max = load_data()[1]
+    avg_map = coarsen_for_display(yearly_max[var].mean(dim='year'))
+
+    # North-up rows, encoded in memory (no GeoTIFF or tile server round-trip)
+    arr = avg_map.sortby('lat', ascending=False).transpose('lat', 'lon').values
+    png = io.BytesIO()
+    mpimg.imsave(png, arr, cmap='viridis', vmin=np.nanmin(arr), vmax=np.nanmax(arr), format='png')
+    return "data:image/png;base64," + base64.b64encode(png.getvalue()).decode(), image_bounds(avg_map)
+
+@st.cache_resource
+def build_folium_map(c_lat, c_lon, bounds_tup, overlay_url):
+    """Folium map with the yearly overlay (or a coverage fallback), built once per input set
+
+    Returns the map and a list of (level, message) status notes for the caller to show.
+    """
+    notes = []
+    folium_map = folium.Map(location=[c_lat, c_lon], zoom_start=6)
+
+    if overlay_url is not None:
+        # Single image layer; the browser handles pan/zoom without a tile server
+        folium.raster_layers.ImageOverlay(
+            image=overlay_url,
+            bounds=[list(corner) for corner in bounds_tup],
+            opacity=0.8,
+            name="Mean Yearly Max Extreme Precip"
+        ).add_to(folium_map)
+        notes.append(("success", "✅ Precipitation overlay added to map!"))
+    else:
         # Add data bounds as a rectangle
-        bounds = [
-            [float(ds.lat.min()), float(ds.lon.min())],
-            [float(ds.lat.max()), float(ds.lon.max())]
-        ]
-        
         folium.Rectangle(
-            bounds=bounds,
+            bounds=[list(corner) for corner in bounds_tup],
             color='red',
             fill=True,
             fillColor='blue',
             fillOpacity=0.2,
             popup='Data Coverage Area'
-        ).add_to(m)
-        
-        st.info("💡 Added data bounds rectangle as fallback")
-        
-    except Exception as e2:
-        st.error(f"❌ Error with fallback visualization: {str(e2)}")
-        # Create basic leafmap without raster
-        m = leafmap.Map(center=[center_lat, center_lon], zoom=6)
+        ).add_to(folium_map)
+        notes.append(("info", "💡 Added data bounds rectangle as fallback"))
+
+    # Add layer control
+    folium.LayerControl().add_to(folium_map)
+    return folium_map, notes
 
-# Convert to folium but keep the raster
+st.title("🌧️ Extreme Rainfall Explorer")
+st.write("**Click anywhere on the map** to view rainfall time series at that location.")
+
+ds, yearly_ds, yearly_mean_map = load_data()
+grid = load_grid()
+bounds = load_bounds()
+
+# Render the yearly mean overlay (cached across reruns and restarts); the map is
+# placed on cell edges, half a grid step outside the outermost cell centres
+overlay_url = None
+overlay_bounds = image_bounds(yearly_mean_map)
 try:
-    folium_map = m.to_folium()
-except:
-    # If m is already folium, use it directly
-    folium_map = m
+    overlay_url, overlay_bounds = build_yearly_overlay("pr", os.path.getmtime("data/sample.nc"))
+except Exception as e:
+    st.error(f"❌ Error creating precipitation overlay: {str(e)}")
 
-# Add layer control
-folium.LayerControl().add_to(folium_map)
+# Create the map with the yearly overlay (built once, reused across reruns)
+center_lat = bounds.center_lat
+center_lon = bounds.center_lon
+rect_bounds = tuple(tuple(corner) for corner in overlay_bounds)
+(extent_south, extent_west), (extent_north, extent_east) = overlay_bounds
+
+folium_map, map_notes = build_folium_map(center_lat, center_lon, rect_bounds, overlay_url)
+for level, message in map_notes:
+    getattr(st, level)(message)
 
 # Display the map with click functionality
 st.subheader("Interactive Map")
-map_data = st_folium(folium_map, height=600, width=800)
+map_data = st_folium(folium_map, height=600, width=800,
+                     returned_objects=['last_clicked'], key='precip_map')
 
 # Show data bounds and information
-st.info(f"📍 Data coverage: Latitude {ds.lat.min().values:.2f}° to {ds.lat.max().values:.2f}°, "
-        f"Longitude {ds.lon.min().values:.2f}° to {ds.lon.max().values:.2f}°")
+st.info(f"📍 Data coverage: Latitude {extent_south:.2f}° to {extent_north:.2f}°, "
+        f"Longitude {extent_west:.2f}° to {extent_east:.2f}°")
 
 # Show data statistics
 with st.expander("📊 Dataset Information"):
     st.write(f"**Original data shape:** {ds.dims}")
-    st.write(f"**Time range:** {ds.time.min().values} to {ds.time.max().values}")
+    # Monotonic coordinates: the ends are the range; the map range is one numpy read
+    time_first, time_last = ds.time.values[[0, -1]]
+    year_first, year_last = yearly_ds.year.values[[0, -1]]
+    ym = yearly_mean_map.values
+    st.write(f"**Time range:** {time_first} to {time_last}")
     st.write(f"**Yearly data shape:** {yearly_ds.dims}")
-    st.write(f"**Year range:** {yearly_ds.year.min().values} to {yearly_ds.year.max().values}")
-    st.write(f"**Yearly mean map range:** {yearly_mean_map.min().values:.6f} to {yearly_mean_map.max().values:.6f}")
+    st.write(f"**Year range:** {year_first} to {year_last}")
+    st.write(f"**Yearly mean map range:** {np.nanmin(ym):.6f} to {np.nanmax(ym):.6f}")
     st.write(f"**Variables:** {list(ds.data_vars.keys())}")
 
 # Initialize session state for clicked coordinates
@@ -134,9 +190,8 @@ if 'clicked_coords' not in st.session_state:
 if map_data and map_data['last_clicked']:
     clicked_lat = map_data['last_clicked']['lat']
     clicked_lon = map_data['last_clicked']['lng']
-    # Check if the click is within data bounds
-    if (ds.lat.min() <= clicked_lat <= ds.lat.max() and 
-        ds.lon.min() <= clicked_lon <= ds.lon.max()):
+    # Check the click against the same cell-edge extent the map draws
+    if within(overlay_bounds, clicked_lat, clicked_lon):
         st.session_state.clicked_coords = (clicked_lat, clicked_lon)
     else:
         st.warning(f"⚠️ Clicked location ({clicked_lat:.2f}, {clicked_lon:.2f}) is outside data coverage area!")
@@ -145,13 +200,9 @@ if map_data and map_data['last_clicked']:
 st.subheader("Manual Coordinate Input")
 col1, col2, col3 = st.columns([1, 1, 1])
 with col1:
-    lat_min, lat_max = float(ds.lat.min()), float(ds.lat.max())
-    lat_default = (lat_min + lat_max) / 2
-    selected_lat = st.number_input("Latitude", value=lat_default, min_value=lat_min, max_value=lat_max, key="lat_input")
+    selected_lat = st.number_input("Latitude", value=bounds.center_lat, min_value=extent_south, max_value=extent_north, key="lat_input")
 with col2:
-    lon_min, lon_max = float(ds.lon.min()), float(ds.lon.max())
-    lon_default = (lon_min + lon_max) / 2
-    selected_lon = st.number_input("Longitude", value=lon_default, min_value=lon_min, max_value=lon_max, key="lon_input")
+    selected_lon = st.number_input("Longitude", value=bounds.center_lon, min_value=extent_west, max_value=extent_east, key="lon_input")
 with col3:
     st.write("")  # Empty space for alignment
     st.write("")  # Empty space for alignment
@@ -165,41 +216,40 @@ if st.session_state.clicked_coords:
     
     try:
         # Select the nearest point from yearly data
-        ts_yearly = yearly_ds['pr'].sel(lat=lat, lon=lon, method='nearest')
-        actual_lat = float(ts_yearly.lat.values)
-        actual_lon = float(ts_yearly.lon.values)
-        
-        # Convert to dataframe for plotting
-        df_yearly = ts_yearly.to_dataframe().reset_index()
-        df_yearly.columns = ['year', 'pr']
+        iy, ix = nearest_ij(lat, lon, grid)
+        actual_lat = float(yearly_ds.lat[iy])
+        actual_lon = float(yearly_ds.lon[ix])
         
-        # Create the yearly time series plot
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.plot(df_yearly['year'], df_yearly['pr'], linewidth=2, color='#1f77b4', marker='o', markersize=6)
-        ax.set_title(f"Yearly Maximum Extreme Rainfall Time Series\nSelected: ({lat:.2f}, {lon:.2f}) → Actual Grid Point: ({actual_lat:.2f}, {actual_lon:.2f})", 
-                    fontsize=14, fontweight='bold')
-        ax.set_ylabel("Yearly Maximum Extreme Rainfall (kg m⁻² s⁻¹)", fontsize=12)
-        ax.set_xlabel("Year", fontsize=12)
-        ax.grid(True, alpha=0.3)
+        # Cached dataframe for plotting
+        df_yearly = get_ts_df(iy, ix)
         
-        # Add trend line
-        z = np.polyfit(df_yearly['year'], df_yearly['pr'], 1)
+        # Add trend line (coefficients precomputed for every cell)
+        stats = load_grid_stats()
+        z = (stats['slope'][iy, ix], stats['intercept'][iy, ix])
         p = np.poly1d(z)
-        ax.plot(df_yearly['year'], p(df_yearly['year']), "r--", alpha=0.8, linewidth=2, label=f'Trend: {z[0]:.2e} per year')
-        ax.legend()
+        df_plot = df_yearly.assign(trend=p(df_yearly['year']))
         
-        plt.tight_layout()
-        st.pyplot(fig)
+        # Create the yearly time series chart (rendered client-side by Vega-Lite)
+        x_year = alt.X('year:Q', title="Year", axis=alt.Axis(format='d'))
+        line = alt.Chart(df_plot).mark_line(point=True, color='#1f77b4').encode(
+            x=x_year, y=alt.Y('pr:Q', title="Yearly Maximum Extreme Rainfall (kg m⁻² s⁻¹)"))
+        trend = alt.Chart(df_plot).mark_line(color='red', strokeDash=[6, 4]).encode(x=x_year, y='trend:Q')
+        chart = (line + trend).properties(
+            title=["Yearly Maximum Extreme Rainfall Time Series",
+                   f"Selected: ({lat:.2f}, {lon:.2f}) → Actual Grid Point: ({actual_lat:.2f}, {actual_lon:.2f})"])
+        st.altair_chart(chart, use_container_width=True)
+        st.caption(f"Red dashed line — trend: {z[0]:.2e} per year")
         
-        # Display statistics
+        # Display statistics (precomputed for the whole grid, indexed per cell)
+        pr_max, pr_min, pr_mean = stats['max'][iy, ix], stats['min'][iy, ix], stats['mean'][iy, ix]
         st.subheader("📊 Yearly Statistics")
         col1, col2, col3, col4 = st.columns(4)
         with col1:
-            st.metric("Maximum", f"{df_yearly['pr'].max():.4f}", delta=f"{df_yearly['pr'].max() - df_yearly['pr'].mean():.4f}")
+            st.metric("Maximum", f"{pr_max:.4f}", delta=f"{pr_max - pr_mean:.4f}")
         with col2:
-            st.metric("Minimum", f"{df_yearly['pr'].min():.4f}", delta=f"{df_yearly['pr'].min() - df_yearly['pr'].mean():.4f}")
+            st.metric("Minimum", f"{pr_min:.4f}", delta=f"{pr_min - pr_mean:.4f}")
         with col3:
-            st.metric("Mean", f"{df_yearly['pr'].mean():.4f}")
+            st.metric("Mean", f"{pr_mean:.4f}")
         with col4:
             st.metric("Trend/Year", f"{z[0]:.2e}")
             
@@ -209,22 +259,18 @@ if st.session_state.clicked_coords:
         
         with col1:
             # Histogram
-            fig_hist, ax_hist = plt.subplots(figsize=(8, 5))
-            ax_hist.hist(df_yearly['pr'], bins=20, alpha=0.7, color='skyblue', edgecolor='black')
-            ax_hist.set_title("Distribution of Yearly Maximum Rainfall")
-            ax_hist.set_xlabel("Rainfall (kg m⁻² s⁻¹)")
-            ax_hist.set_ylabel("Frequency")
-            ax_hist.grid(True, alpha=0.3)
-            st.pyplot(fig_hist)
+            hist = alt.Chart(df_yearly).mark_bar(color='skyblue').encode(
+                alt.X('pr:Q', bin=alt.Bin(maxbins=20), title="Rainfall (kg m⁻² s⁻¹)"),
+                alt.Y('count()', title="Frequency")
+            ).properties(title="Distribution of Yearly Maximum Rainfall")
+            st.altair_chart(hist, use_container_width=True)
             
         with col2:
             # Box plot
-            fig_box, ax_box = plt.subplots(figsize=(6, 5))
-            ax_box.boxplot(df_yearly['pr'], vert=True)
-            ax_box.set_title("Box Plot of Yearly Maximum Rainfall")
-            ax_box.set_ylabel("Rainfall (kg m⁻² s⁻¹)")
-            ax_box.grid(True, alpha=0.3)
-            st.pyplot(fig_box)
+            box = alt.Chart(df_yearly).mark_boxplot(extent='min-max').encode(
+                alt.Y('pr:Q', title="Rainfall (kg m⁻² s⁻¹)")
+            ).properties(title="Box Plot of Yearly Maximum Rainfall")
+            st.altair_chart(box, use_container_width=True)
             
         # Show periods analysis
         st.subheader("🔍 Period Analysis")
@@ -246,13 +292,14 @@ if st.session_state.clicked_coords:
             
         # Show data table
         with st.expander("📋 View Yearly Data"):
-            st.dataframe(df_yearly.style.format({'pr': '{:.6f}'}))
+            st.dataframe(df_yearly.head(MAX_TABLE_ROWS),
+                         column_config={'pr': st.column_config.NumberColumn(format='%.6f')})
+            st.caption(f"Showing {min(MAX_TABLE_ROWS, len(df_yearly))} of {len(df_yearly)} rows")
             
         # Add download button for the yearly data
-        csv = df_yearly.to_csv(index=False)
         st.download_button(
             label="📥 Download Yearly Data as CSV",
-            data=csv,
+            data=ts_csv(iy, ix),
             file_name=f"yearly_rainfall_data_{lat:.2f}_{lon:.2f}.csv",
             mime="text/csv"
         )
@@ -268,3 +315,33 @@ st.info("💡 **Instructions:** Click anywhere on the map above to generate a ye
 if st.button("🗑️ Clear Selection"):
     st.session_state.clicked_coords = None
     st.rerun()
+
+# Batch extraction for a list of locations (e.g. station coordinates)
+st.subheader("📌 Batch Extraction")
+uploaded = st.file_uploader("Upload a CSV with 'lat' and 'lon' columns", type="csv")
+if uploaded is not None:
+    try:
+        points = pd.read_csv(uploaded)
+        lats, lons = points['lat'].values, points['lon'].values
+        # Same coverage test and snapping as a map click, so points off the grid are dropped
+        inside = within(overlay_bounds, lats, lons)
+        if not inside.all():
+            st.warning(f"⚠️ Skipped {int((~inside).sum())} location(s) outside data coverage")
+        if inside.any():
+            iys, ixs = nearest_ij(lats[inside], lons[inside], grid)
+            batch = yearly_ds['pr'].isel(lat=xr.DataArray(iys, dims='point'),
+                                         lon=xr.DataArray(ixs, dims='point'))
+            # Keep the uploaded row number and coordinates so rows match back to their stations
+            batch = batch.assign_coords(point=np.flatnonzero(inside),
+                                        input_lat=('point', lats[inside]),
+                                        input_lon=('point', lons[inside]))
+            df_batch = batch.to_dataframe().reset_index()
+            st.success(f"✅ Extracted yearly maxima for {int(inside.sum())} locations")
+            st.download_button(
+                label="📥 Download Batch Data as CSV",
+                data=df_batch.to_csv(index=False),
+                file_name="yearly_rainfall_batch.csv",
+                mime="text/csv"
+            )
+    except Exception as e:
+        st.error(f"❌ Error extracting batch data: {str(e)}")
@@ -1,28 +1,79 @@
+import os
+import io
+import base64
+import glob
+import hashlib
 import streamlit as st
 import xarray as xr
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
+import altair as alt
 import folium
 from streamlit_folium import st_folium
-import leafmap.foliumap as leafmap
 import rioxarray as rxr
+from rasterio.io import MemoryFile
+from convert_to_zarr import ensure_zarr
+from grid_utils import MAX_TABLE_ROWS, grid_bounds, image_bounds, nearest_index, coarsen_for_display, cell_stats, within
+
+# Yearly reductions persisted across processes, keyed on the source file
+CACHE_DIR = "cache"
+# Bump whenever the processing changes what a cache file holds, so old files are not reused
+CACHE_VERSION = 2
+# 256-entry viridis ramp as RGB bytes, indexed by a value scaled to 0-255
+VIRIDIS_LUT = (plt.get_cmap('viridis')(np.linspace(0, 1, 256))[:, :3] * 255).astype(np.uint8)
 
 st.set_page_config(page_title="🌧️ Flood Storm Dashboard", layout="wide")
 
 st.title("🌧️ Extreme Rainfall Explorer")
 st.markdown("**Click anywhere on the map to view yearly maximum rainfall time series at that location.**")
 
+def yearly_cache_path(nc_path):
+    """Disk cache location for the yearly maxima, changing whenever the source file does"""
+    stat = os.stat(nc_path)
+    key = hashlib.sha1(f"{CACHE_VERSION}-{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()[:16]
+    return os.path.join(CACHE_DIR, f"yearly_max_{key}.nc")
+
+def publish_cache_file(tmp_path, cache_path, pattern):
+    """Move a finished cache file into place and delete the stale files it supersedes"""
+    os.replace(tmp_path, cache_path)
+    for old_path in glob.glob(os.path.join(CACHE_DIR, pattern)):
+        if old_path != cache_path:
+            os.remove(old_path)
+
 @st.cache_resource
 def load_and_process_data():
     """Load NetCDF data and process it for yearly analysis"""
     try:
-        # Load dataset
-        ds = xr.open_dataset("data/sample.nc", engine="netcdf4")
+        # Load the chunked Zarr store lazily
+        ds = xr.open_dataset(ensure_zarr("data/sample.nc"), engine="zarr", consolidated=True,
+                             chunks={"time": -1, "lat": 64, "lon": 64}, mask_and_scale=False)
+        ds['pr'] = ds['pr'].astype('float32')
         
-        # Use xarray's native datetime handling for grouping
-        # Group by year and calculate maximum (extreme values)
-        yearly_max = ds.groupby(ds['time'].dt.year).max('time')
+        cache_path = yearly_cache_path("data/sample.nc")
+        if os.path.exists(cache_path):
+            # A previous process already reduced this exact file
+            with xr.open_dataset(cache_path, engine="h5netcdf") as cached:
+                yearly_max = cached.load()
+        else:
+            # Use xarray's native datetime handling for grouping
+            # Group by year and calculate maximum (extreme values)
+            yearly_max = ds.groupby(ds['time'].dt.year).max('time', engine="flox", method="cohorts").compute()
+            # Trailing ellipsis keeps CF bounds variables (lat_bnds/lon_bnds over 'bnds') valid
+            yearly_max = yearly_max.transpose('year', 'lat', 'lon', ...)
+            
+            # Write under a temporary name so concurrent workers never read a partial file
+            os.makedirs(CACHE_DIR, exist_ok=True)
+            tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+            chunksizes = (1, min(64, yearly_max.sizes['lat']), min(64, yearly_max.sizes['lon']))
+            # Lossless float32 so every process shows the same numbers; the store was opened
+            # with mask_and_scale=False, so its raw _FillValue attr must not be written back
+            to_write = yearly_max.copy()
+            to_write['pr'].attrs.pop('_FillValue', None)
+            to_write.to_netcdf(tmp_path, engine="h5netcdf",
+                               encoding={"pr": {"dtype": "float32", "zlib": True, "complevel": 3,
+                                                "chunksizes": chunksizes}})
+            publish_cache_file(tmp_path, cache_path, "yearly_max_*.nc")
         
         # Calculate mean across years for mapping
         yearly_mean = yearly_max['pr'].mean(dim='year')
@@ -31,6 +82,178 @@ def load_and_process_data():
     except Exception as e:
         return None, None, None, str(e)
 
+@st.cache_resource
+def load_bounds():
+    return grid_bounds(load_and_process_data()[0])
+
+@st.cache_resource
+def load_extent():
+    """Cell-edge extent of the displayed grid, shared by the map layers and click checks"""
+    return image_bounds(coarsen_for_display(load_and_process_data()[2]))
+
+@st.cache_resource
+def build_raster() -> MemoryFile:
+    """Encode the yearly mean as a Cloud-Optimized GeoTIFF served from memory
+
+    The MemoryFile lives as long as this cache entry, so readers opened on it stay valid.
+    The encoded bytes are also kept on disk under a content hash, so other processes
+    load them instead of rasterizing again.
+    """
+    _, _, yearly_mean, _ = load_and_process_data()
+    yearly_mean = coarsen_for_display(yearly_mean)
+    # Set spatial dims and CRS
+    yearly_mean = yearly_mean.rio.set_spatial_dims(x_dim="lon", y_dim="lat")
+    yearly_mean = yearly_mean.rio.write_crs("EPSG:4326")
+    arr = yearly_mean.transpose('lat', 'lon').values.astype('float32')
+    transform = yearly_mean.rio.transform()
+
+    digest = hashlib.sha1(arr.tobytes() + repr((CACHE_VERSION, tuple(transform))).encode()).hexdigest()[:12]
+    cog_path = os.path.join(CACHE_DIR, f"yearly_mean_{digest}.tif")
+    if os.path.exists(cog_path):
+        with open(cog_path, 'rb') as f:
+            return MemoryFile(f.read())
+
+    # The COG driver lays out 256px tiles with the overview pyramid ahead of the
+    # full-resolution data, so a reader fetches only the level its zoom needs
+    memfile = MemoryFile()
+    with memfile.open(driver="COG", height=arr.shape[0], width=arr.shape[1], count=1,
+                      dtype="float32", crs="EPSG:4326", transform=transform,
+                      nodata=np.nan, blocksize=256, compress="DEFLATE",
+                      overview_resampling="AVERAGE") as dst:
+        dst.write(arr, 1)
+
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = f"{cog_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(memfile.getbuffer())
+    publish_cache_file(tmp_path, cog_path, "yearly_mean_*.tif")
+    return memfile
+
+@st.cache_resource
+def load_point_cube():
+    """Yearly pr as a contiguous (lat, lon, year) numpy cube plus ascending coordinate arrays"""
+    _, yearly_ds, _, _ = load_and_process_data()
+    yearly_pr = yearly_ds['pr'].sortby('lat').sortby('lon')
+    years = yearly_pr.year.values
+    lats = yearly_pr.lat.values
+    lons = yearly_pr.lon.values
+    cube = np.ascontiguousarray(yearly_pr.transpose('lat', 'lon', 'year').values)
+    return years, lats, lons, cube
+
+@st.cache_resource
+def load_grid_stats():
+    """Per-cell trend coefficients and summary statistics, computed for the whole grid at once"""
+    years, _, _, cube = load_point_cube()
+    nlat, nlon, nyear = cube.shape
+    stats = cell_stats(years, cube.reshape(-1, nyear).T)
+    return {name: values.reshape(nlat, nlon) for name, values in stats.items()}
+
+@st.cache_data(max_entries=256)
+def series_csv(i: int, j: int) -> bytes:
+    years, _, _, cube = load_point_cube()
+    return pd.DataFrame({'year': years, 'pr': cube[i, j]}).to_csv(index=False).encode()
+
+def snap_cell(lat, lon):
+    """Compact int32 (i, j) cube indices of the grid cell nearest to a coordinate"""
+    _, lats, lons, _ = load_point_cube()
+    return np.int32(nearest_index(lats, lat)), np.int32(nearest_index(lons, lon))
+
+@st.cache_resource
+def build_folium_map():
+    """Folium map with the yearly overlay (or the grid fallback), plus status notes"""
+    _, _, yearly_mean, _ = load_and_process_data()
+    bounds = load_bounds()
+    center_lat, center_lon = bounds.center_lat, bounds.center_lon
+    notes = []
+    folium_map = folium.Map(location=[center_lat, center_lon], zoom_start=6)
+
+    # Method 1: Try leafmap raster overlay
+    overlay_success = False
+    try:
+        # In-memory GeoTIFF (encoded once per process, never written to disk)
+        raster = build_raster().open()
+    
+        # Create leafmap; imported here so reruns that never reach the raster path skip it
+        import leafmap.foliumap as leafmap
+        m = leafmap.Map(center=[center_lat, center_lon], zoom=6)
+        m.add_raster(raster, 
+                     layer_name="Yearly Max Precipitation", 
+                     opacity=0.8, 
+                     colormap="viridis")
+    
+        # Convert to folium
+        folium_map = m.to_folium()
+        overlay_success = True
+        notes.append(("success", "✅ Leafmap raster overlay created successfully!"))
+    
+    except Exception as e:
+        notes.append(("warning", f"⚠️ Leafmap method failed: {str(e)}"))
+
+    # Method 2: If leafmap fails, create detailed grid visualization
+    if not overlay_success:
+        notes.append(("info", "💡 Using enhanced grid visualization instead of raster overlay"))
+    
+        # Block-average the grid itself (south row first) rather than point-sampling it;
+        # it is drawn as one bitmap, so resolution no longer costs map elements
+        display = coarsen_for_display(yearly_mean).sortby('lat').sortby('lon').transpose('lat', 'lon')
+        grid_vals = display.values
+    
+        # Add data coverage rectangle on cell edges, half a step outside the cell centres
+        rect_bounds = load_extent()
+    
+        folium.Rectangle(
+            bounds=rect_bounds,
+            color='red',
+            fill=True,
+            fillColor='red',
+            fillOpacity=0.1,
+            popup='Data Coverage Area'
+        ).add_to(folium_map)
+    
+        # Get min/max for color scaling
+        min_val = yearly_mean.min().values
+        max_val = yearly_mean.max().values
+    
+        # Color every sample at once through the viridis lookup table
+        normalized = np.nan_to_num((grid_vals - min_val) / (max_val - min_val))
+        rgb = VIRIDIS_LUT[np.clip(normalized * 255, 0, 255).astype(np.uint8)]
+    
+        # Draw the grid as one PNG overlay (north row first), transparent where data is missing
+        alpha = np.where(np.isfinite(grid_vals), 255, 0).astype(np.uint8)
+        rgba = np.dstack([rgb, alpha])[::-1]
+        png = io.BytesIO()
+        plt.imsave(png, rgba, format='png')
+        folium.raster_layers.ImageOverlay(
+            image="data:image/png;base64," + base64.b64encode(png.getvalue()).decode(),
+            bounds=rect_bounds,
+            opacity=0.8,
+            name="Yearly Max Precipitation"
+        ).add_to(folium_map)
+    
+        # Add custom legend
+        legend_html = '''
+        <div style="position: fixed; 
+                    top: 10px; right: 10px; width: 200px; height: 150px; 
+                    background-color: white; border:2px solid grey; z-index:9999; 
+                    font-size:12px; padding: 10px; border-radius: 5px;">
+        <h4 style="margin: 0 0 10px 0;">Precipitation</h4>
+        <div style="background: linear-gradient(to top, #440154, #31688e, #35b779, #fde725); 
+                    height: 80px; width: 20px; margin: 5px 0; float: left;"></div>
+        <div style="margin-left: 30px; font-size: 10px;">
+            <div style="margin-bottom: 50px;">High</div>
+            <div>Low</div>
+        </div>
+        <div style="clear: both; font-size: 10px; margin-top: 5px;">kg m⁻² s⁻¹</div>
+        </div>
+        '''
+        folium_map.get_root().html.add_child(folium.Element(legend_html))
+    
+        notes.append(("success", "✅ Enhanced grid visualization created!"))
+
+    # Add layer control
+    folium.LayerControl().add_to(folium_map)
+    return folium_map, notes
+
 # Load data
 ds, yearly_ds, yearly_mean, error = load_and_process_data()
 
@@ -38,167 +261,66 @@ if error:
     st.error(f"❌ Error loading data: {error}")
     st.stop()
 
+bounds = load_bounds()
+extent = load_extent()
+(extent_south, extent_west), (extent_north, extent_east) = extent
+
 # Display dataset info
 with st.expander("📊 Dataset Information"):
     col1, col2 = st.columns(2)
     with col1:
         st.write("**Original Dataset:**")
         st.write(f"- Shape: {dict(ds.dims)}")
-        st.write(f"- Time range: {ds.time.min().values} to {ds.time.max().values}")
+        # Time is monotonic, so the ends of the coordinate are its range
+        time_first, time_last = ds.time.values[[0, -1]]
+        st.write(f"- Time range: {time_first} to {time_last}")
     
     with col2:
         st.write("**Yearly Processed Data:**")
         st.write(f"- Shape: {dict(yearly_ds.dims)}")
-        st.write(f"- Year range: {yearly_ds.year.min().values} to {yearly_ds.year.max().values}")
+        year_first, year_last = yearly_ds.year.values[[0, -1]]
+        st.write(f"- Year range: {year_first} to {year_last}")
 
 # Create map
 st.subheader("🗺️ Interactive Map")
 
 # Get map center and bounds
-center_lat = float((ds.lat.min() + ds.lat.max()) / 2)
-center_lon = float((ds.lon.min() + ds.lon.max()) / 2)
+center_lat = bounds.center_lat
+center_lon = bounds.center_lon
 
 # Create map with precipitation data overlay
 st.write("**Creating precipitation overlay...**")
 
 # Debug information
 st.write(f"- Data shape: {yearly_mean.shape}")
-st.write(f"- Data range: {yearly_mean.min().values:.6f} to {yearly_mean.max().values:.6f}")
-
-# Create folium map
-folium_map = folium.Map(location=[center_lat, center_lon], zoom_start=6)
-
-# Method 1: Try leafmap raster overlay
-overlay_success = False
-try:
-    # Ensure we have rio accessor
-    if not hasattr(yearly_mean, 'rio'):
-        yearly_mean = yearly_mean.rio.set_spatial_dims(x_dim="lon", y_dim="lat")
-    
-    # Set CRS
-    yearly_mean = yearly_mean.rio.write_crs("EPSG:4326")
-    
-    # Save to GeoTIFF
-    yearly_mean.rio.to_raster("temp_yearly_mean.tif")
-    
-    # Create leafmap
-    m = leafmap.Map(center=[center_lat, center_lon], zoom=6)
-    m.add_raster("temp_yearly_mean.tif", 
-                 layer_name="Yearly Max Precipitation", 
-                 opacity=0.8, 
-                 colormap="viridis")
-    
-    # Convert to folium
-    folium_map = m.to_folium()
-    overlay_success = True
-    st.success("✅ Leafmap raster overlay created successfully!")
-    
-except Exception as e:
-    st.warning(f"⚠️ Leafmap method failed: {str(e)}")
-
-# Method 2: If leafmap fails, create detailed grid visualization
-if not overlay_success:
-    st.info("💡 Using enhanced grid visualization instead of raster overlay")
-    
-    # Add data coverage rectangle
-    bounds = [
-        [float(ds.lat.min()), float(ds.lon.min())],
-        [float(ds.lat.max()), float(ds.lon.max())]
-    ]
-    
-    folium.Rectangle(
-        bounds=bounds,
-        color='red',
-        fill=True,
-        fillColor='red',
-        fillOpacity=0.1,
-        popup='Data Coverage Area'
-    ).add_to(folium_map)
-    
-    # Create high-resolution grid overlay
-    lat_points = np.linspace(ds.lat.min(), ds.lat.max(), 30)
-    lon_points = np.linspace(ds.lon.min(), ds.lon.max(), 30)
-    
-    # Get min/max for color scaling
-    min_val = yearly_mean.min().values
-    max_val = yearly_mean.max().values
-    
-    # Add colored grid points
-    for i, lat in enumerate(lat_points):
-        for j, lon in enumerate(lon_points):
-            try:
-                value = yearly_mean.sel(lat=lat, lon=lon, method='nearest').values
-                
-                # Normalize for color (0-1)
-                normalized = (value - min_val) / (max_val - min_val)
-                
-                # Create viridis-like color
-                if normalized < 0.25:
-                    color = f'rgb({int(68*normalized/0.25)}, {int(1*normalized/0.25)}, {int(84*normalized/0.25)})'
-                elif normalized < 0.5:
-                    color = f'rgb({int(49*(normalized-0.25)/0.25)}, {int(104*(normalized-0.25)/0.25)}, {int(142*(normalized-0.25)/0.25)})'
-                elif normalized < 0.75:
-                    color = f'rgb({int(53*(normalized-0.5)/0.25)}, {int(183*(normalized-0.5)/0.25)}, {int(121*(normalized-0.5)/0.25)})'
-                else:
-                    color = f'rgb({int(253*(normalized-0.75)/0.25)}, {int(231*(normalized-0.75)/0.25)}, {int(37*(normalized-0.75)/0.25)})'
-                
-                folium.CircleMarker(
-                    location=[float(lat), float(lon)],
-                    radius=2,
-                    popup=f'Precipitation: {value:.6f}<br>Lat: {lat:.2f}, Lon: {lon:.2f}',
-                    color=color,
-                    fill=True,
-                    fillColor=color,
-                    fillOpacity=0.8,
-                    weight=1
-                ).add_to(folium_map)
-                
-            except Exception as e:
-                continue
-    
-    # Add custom legend
-    legend_html = '''
-    <div style="position: fixed; 
-                top: 10px; right: 10px; width: 200px; height: 150px; 
-                background-color: white; border:2px solid grey; z-index:9999; 
-                font-size:12px; padding: 10px; border-radius: 5px;">
-    <h4 style="margin: 0 0 10px 0;">Precipitation</h4>
-    <div style="background: linear-gradient(to top, #440154, #31688e, #35b779, #fde725); 
-                height: 80px; width: 20px; margin: 5px 0; float: left;"></div>
-    <div style="margin-left: 30px; font-size: 10px;">
-        <div style="margin-bottom: 50px;">High</div>
-        <div>Low</div>
-    </div>
-    <div style="clear: both; font-size: 10px; margin-top: 5px;">kg m⁻² s⁻¹</div>
-    </div>
-    '''
-    folium_map.get_root().html.add_child(folium.Element(legend_html))
-    
-    st.success("✅ Enhanced grid visualization created!")
+ym = yearly_mean.values
+st.write(f"- Data range: {np.nanmin(ym):.6f} to {np.nanmax(ym):.6f}")
 
-# Add layer control
-folium.LayerControl().add_to(folium_map)
+# Create folium map (cached; only the status notes are re-emitted per rerun)
+folium_map, map_notes = build_folium_map()
+for level, message in map_notes:
+    getattr(st, level)(message)
 
-# Display the map
-map_data = st_folium(folium_map, height=600, width=None)
+# Display the map; only the click location is sent back, so pan/zoom does not rerun the script
+map_data = st_folium(folium_map, height=600, width=None,
+                     returned_objects=['last_clicked'], key='precip_map')
 
 # Show data coverage info
-st.info(f"📍 **Data Coverage:** Latitude {ds.lat.min().values:.2f}° to {ds.lat.max().values:.2f}°, "
-        f"Longitude {ds.lon.min().values:.2f}° to {ds.lon.max().values:.2f}°")
+st.info(f"📍 **Data Coverage:** Latitude {extent_south:.2f}° to {extent_north:.2f}°, "
+        f"Longitude {extent_west:.2f}° to {extent_east:.2f}°")
 
 # Initialize session state
-if 'selected_coords' not in st.session_state:
-    st.session_state.selected_coords = None
+if 'selected_cell' not in st.session_state:
+    st.session_state.selected_cell = None
 
 # Handle map clicks
 if map_data and map_data['last_clicked']:
     clicked_lat = map_data['last_clicked']['lat']
     clicked_lon = map_data['last_clicked']['lng']
     
-    # Validate click is within data bounds
-    if (ds.lat.min() <= clicked_lat <= ds.lat.max() and 
-        ds.lon.min() <= clicked_lon <= ds.lon.max()):
-        st.session_state.selected_coords = (clicked_lat, clicked_lon)
+    # Validate click against the drawn coverage (cell edges), then snap to a cell
+    if within(extent, clicked_lat, clicked_lon):
+        st.session_state.selected_cell = snap_cell(clicked_lat, clicked_lon)
         st.success(f"🎯 Selected location: {clicked_lat:.2f}, {clicked_lon:.2f}")
     else:
         st.warning(f"⚠️ Location ({clicked_lat:.2f}, {clicked_lon:.2f}) is outside data coverage!")
@@ -211,8 +333,8 @@ with col1:
     manual_lat = st.number_input(
         "Latitude", 
         value=center_lat, 
-        min_value=float(ds.lat.min()), 
-        max_value=float(ds.lat.max()),
+        min_value=extent_south, 
+        max_value=extent_north,
         format="%.2f"
     )
 
@@ -220,116 +342,116 @@ with col2:
     manual_lon = st.number_input(
         "Longitude", 
         value=center_lon, 
-        min_value=float(ds.lon.min()), 
-        max_value=float(ds.lon.max()),
+        min_value=extent_west, 
+        max_value=extent_east,
         format="%.2f"
     )
 
 with col3:
     st.write("")  # spacer
     if st.button("📍 Select Location", type="primary"):
-        st.session_state.selected_coords = (manual_lat, manual_lon)
+        st.session_state.selected_cell = snap_cell(manual_lat, manual_lon)
 
-# Generate time series if coordinates are selected
-if st.session_state.selected_coords:
-    lat, lon = st.session_state.selected_coords
-    
+@st.fragment
+def render_series(i, j):
+    """Time series panel for grid cell (i, j); widgets inside rerun only this fragment"""
     try:
-        # Get time series at selected location
-        ts = yearly_ds['pr'].sel(lat=lat, lon=lon, method='nearest')
-        actual_lat = float(ts.lat.values)
-        actual_lon = float(ts.lon.values)
+        # Get time series at the snapped cell: a contiguous slice of the cube
+        years, lats, lons, cube = load_point_cube()
+        series = cube[i, j]
+        actual_lat = float(lats[i])
+        actual_lon = float(lons[j])
         
         st.subheader("📈 Time Series Analysis")
-        st.info(f"**Selected:** {lat:.2f}, {lon:.2f} → **Nearest Grid Point:** {actual_lat:.2f}, {actual_lon:.2f}")
-        
-        # Convert to dataframe
-        df = ts.to_dataframe().reset_index()
+        st.info(f"**Nearest Grid Point:** {actual_lat:.2f}, {actual_lon:.2f}")
         
-        # Create time series plot
-        fig, ax = plt.subplots(figsize=(12, 6))
-        ax.plot(df['year'], df['pr'], 'o-', linewidth=2, markersize=6, color='#1f77b4')
-        ax.set_title(f'Yearly Maximum Extreme Precipitation\nLocation: {actual_lat:.2f}°N, {actual_lon:.2f}°E', 
-                     fontsize=14, fontweight='bold')
-        ax.set_xlabel('Year', fontsize=12)
-        ax.set_ylabel('Precipitation (kg m⁻² s⁻¹)', fontsize=12)
-        ax.grid(True, alpha=0.3)
-        
-        # Add trend line
-        z = np.polyfit(df['year'], df['pr'], 1)
+        # Trend line (coefficients precomputed for every cell)
+        stats = load_grid_stats()
+        z = (stats['slope'][i, j], stats['intercept'][i, j])
         p = np.poly1d(z)
-        ax.plot(df['year'], p(df['year']), '--', alpha=0.8, color='red', linewidth=2, 
-                label=f'Trend: {z[0]:.2e} per year')
-        ax.legend()
         
-        plt.tight_layout()
-        st.pyplot(fig)
+        # Create time series chart (rendered client-side by Vega-Lite)
+        df_plot = pd.DataFrame({'year': years, 'pr': series, 'trend': p(years)})
+        x_year = alt.X('year:Q', title="Year", axis=alt.Axis(format='d'))
+        line = alt.Chart(df_plot).mark_line(point=True, color='#1f77b4').encode(
+            x=x_year, y=alt.Y('pr:Q', title="Precipitation (kg m⁻² s⁻¹)"))
+        trend = alt.Chart(df_plot).mark_line(color='red', strokeDash=[6, 4]).encode(x=x_year, y='trend:Q')
+        chart = (line + trend).properties(
+            title=["Yearly Maximum Extreme Precipitation",
+                   f"Location: {actual_lat:.2f}°N, {actual_lon:.2f}°E"], height=400)
+        st.altair_chart(chart, use_container_width=True)
+        st.caption(f"Red dashed line — trend: {z[0]:.2e} per year")
         
         # Statistics
         st.subheader("📊 Statistics")
         col1, col2, col3, col4 = st.columns(4)
         
         with col1:
-            st.metric("Maximum", f"{df['pr'].max():.6f}")
+            st.metric("Maximum", f"{stats['max'][i, j]:.6f}")
         with col2:
-            st.metric("Minimum", f"{df['pr'].min():.6f}")
+            st.metric("Minimum", f"{stats['min'][i, j]:.6f}")
         with col3:
-            st.metric("Mean", f"{df['pr'].mean():.6f}")
+            st.metric("Mean", f"{stats['mean'][i, j]:.6f}")
         with col4:
             st.metric("Trend/Year", f"{z[0]:.2e}")
         
         # Additional analysis
         st.subheader("🔍 Additional Analysis")
         
-        col1, col2 = st.columns(2)
+        finite = series[np.isfinite(series)]
+        if finite.size == 0:
+            st.info("ℹ️ No valid yearly values at this grid cell to summarize.")
+        else:
+            col1, col2 = st.columns(2)
         
-        with col1:
-            # Distribution histogram
-            fig_hist, ax_hist = plt.subplots(figsize=(8, 5))
-            ax_hist.hist(df['pr'], bins=15, alpha=0.7, color='skyblue', edgecolor='black')
-            ax_hist.set_title('Distribution of Yearly Maximum Precipitation')
-            ax_hist.set_xlabel('Precipitation (kg m⁻² s⁻¹)')
-            ax_hist.set_ylabel('Frequency')
-            ax_hist.grid(True, alpha=0.3)
-            st.pyplot(fig_hist)
+            with col1:
+                # Distribution histogram: numpy bins, drawn client-side as a bar chart
+                counts, edges = np.histogram(finite, bins=15)
+                st.markdown("**Distribution of Yearly Maximum Precipitation**")
+                st.bar_chart(pd.DataFrame({'Frequency': counts},
+                                          index=pd.Index(edges[:-1], name='Precipitation (kg m⁻² s⁻¹)')))
         
-        with col2:
-            # Box plot
-            fig_box, ax_box = plt.subplots(figsize=(6, 5))
-            ax_box.boxplot(df['pr'], vert=True, patch_artist=True, 
-                          boxprops=dict(facecolor='lightblue', alpha=0.7))
-            ax_box.set_title('Box Plot of Yearly Maximum Precipitation')
-            ax_box.set_ylabel('Precipitation (kg m⁻² s⁻¹)')
-            ax_box.grid(True, alpha=0.3)
-            st.pyplot(fig_box)
+            with col2:
+                # Box plot summary: five-number summary from one percentile call
+                q_min, q1, median, q3, q_max = np.percentile(finite, [0, 25, 50, 75, 100])
+                st.markdown("**Box Plot Summary of Yearly Maximum Precipitation**")
+                box1, box2, box3 = st.columns(3)
+                box1.metric("Q1", f"{q1:.6f}")
+                box2.metric("Median", f"{median:.6f}")
+                box3.metric("Q3", f"{q3:.6f}")
+                st.caption(f"Whiskers: {q_min:.6f} to {q_max:.6f} · IQR: {q3 - q1:.6f}")
         
         # Period comparison
         st.subheader("📅 Period Comparison")
-        mid_year = int((df['year'].min() + df['year'].max()) / 2)
+        mid_year = int((years.min() + years.max()) / 2)
+        early = years <= mid_year
         
         col1, col2 = st.columns(2)
         
+        # nan-aware with ddof=1 to match the pandas mean/std these metrics used before
         with col1:
-            early_period = df[df['year'] <= mid_year]
-            st.metric(f"Early Period ({df['year'].min()}-{mid_year})", 
-                     f"{early_period['pr'].mean():.6f}",
-                     delta=f"±{early_period['pr'].std():.6f}")
+            early_period = series[early]
+            st.metric(f"Early Period ({years.min()}-{mid_year})", 
+                     f"{np.nanmean(early_period):.6f}",
+                     delta=f"±{np.nanstd(early_period, ddof=1):.6f}")
         
         with col2:
-            late_period = df[df['year'] > mid_year]
-            st.metric(f"Late Period ({mid_year+1}-{df['year'].max()})", 
-                     f"{late_period['pr'].mean():.6f}",
-                     delta=f"±{late_period['pr'].std():.6f}")
+            late_period = series[~early]
+            st.metric(f"Late Period ({mid_year+1}-{years.max()})", 
+                     f"{np.nanmean(late_period):.6f}",
+                     delta=f"±{np.nanstd(late_period, ddof=1):.6f}")
         
-        # Data table
+        # Data table; only the displayed rows become a DataFrame
         with st.expander("📋 View Raw Data"):
-            st.dataframe(df.style.format({'pr': '{:.8f}'}))
+            df = pd.DataFrame({'year': years[:MAX_TABLE_ROWS], 'pr': series[:MAX_TABLE_ROWS]})
+            st.dataframe(df,
+                         column_config={'pr': st.column_config.NumberColumn(format='%.8f')})
+            st.caption(f"Showing {len(df)} of {len(series)} rows")
         
         # Download button
-        csv = df.to_csv(index=False)
         st.download_button(
             label="📥 Download Data (CSV)",
-            data=csv,
+            data=series_csv(i, j),
             file_name=f"precipitation_data_{actual_lat:.2f}_{actual_lon:.2f}.csv",
             mime="text/csv"
         )
@@ -339,10 +461,14 @@ if st.session_state.selected_coords:
         import traceback
         st.error(traceback.format_exc())
 
+# Generate time series if coordinates are selected
+if st.session_state.selected_cell is not None:
+    render_series(*st.session_state.selected_cell)
+
 # Clear selection button
-if st.session_state.selected_coords:
+if st.session_state.selected_cell is not None:
     if st.button("🗑️ Clear Selection"):
-        st.session_state.selected_coords = None
+        st.session_state.selected_cell = None
         st.rerun()
 
 # Footer
@@ -0,0 +1,56 @@
+"""Rewrite data/sample.nc as a chunked, compressed Zarr store.
+
+Run once (the apps also call ensure_zarr() and rebuild a missing or stale store):
+
+    python convert_to_zarr.py [data/sample.nc] [data/sample.zarr]
+"""
+import os
+import sys
+import shutil
+import xarray as xr
+import zarr
+
+# Whole time axis per chunk, so a point time series is one chunk read
+CHUNKS = {"time": -1, "lat": 64, "lon": 64}
+
+def zstd_encoding():
+    """Blosc/zstd compressor encoding in the form the installed zarr major version expects"""
+    if int(zarr.__version__.split(".")[0]) >= 3:
+        from zarr.codecs import BloscCodec
+        return {"compressors": [BloscCodec(cname="zstd", clevel=3, shuffle="shuffle")]}
+    from numcodecs import Blosc
+    return {"compressor": Blosc(cname="zstd", clevel=3)}
+
+def convert(nc_path="data/sample.nc", zarr_path="data/sample.zarr"):
+    """Write `nc_path` to `zarr_path` with CHUNKS and zstd compression
+
+    The store is built under a temporary name and swapped into place, so an interrupted
+    conversion never leaves a partial store at `zarr_path`.
+    """
+    ds = xr.open_dataset(nc_path, engine="netcdf4")
+    # Drop netCDF chunk encodings so the new dask chunks define the store layout
+    for var in ds.variables.values():
+        var.encoding.clear()
+    # Store pr as float32: CF decoding upcasts packed rainfall to float64
+    ds["pr"] = ds["pr"].astype("float32")
+    ds = ds.chunk(CHUNKS)
+    encoding = {"pr": {"chunks": ds["pr"].data.chunksize, **zstd_encoding()}}
+    tmp_path = f"{zarr_path}.{os.getpid()}.tmp"
+    ds.to_zarr(tmp_path, mode="w", encoding=encoding, consolidated=True)
+    # A directory cannot be replaced while non-empty: move the old store aside first
+    if os.path.exists(zarr_path):
+        stale_path = f"{zarr_path}.{os.getpid()}.old"
+        os.replace(zarr_path, stale_path)
+        shutil.rmtree(stale_path)
+    os.replace(tmp_path, zarr_path)
+    return zarr_path
+
+def ensure_zarr(nc_path="data/sample.nc"):
+    """Return the Zarr store next to `nc_path`, converting it first if missing or stale"""
+    zarr_path = os.path.splitext(nc_path)[0] + ".zarr"
+    if not os.path.exists(zarr_path) or os.path.getmtime(zarr_path) < os.path.getmtime(nc_path):
+        convert(nc_path, zarr_path)
+    return zarr_path
+
+if __name__ == "__main__":
+    print(f"Wrote {convert(*sys.argv[1:3])}")
@@ -0,0 +1,83 @@
+"""Grid and display helpers shared by the dashboard apps"""
+from collections import namedtuple
+import numpy as np
+
+# Rows rendered in data tables; the CSV download carries the full series
+MAX_TABLE_ROWS = 200
+
+Bounds = namedtuple('Bounds', ['lat_min', 'lat_max', 'lon_min', 'lon_max', 'center_lat', 'center_lon'])
+
+def grid_bounds(ds):
+    """Coordinate extent and map center of `ds`, reduced to Python floats"""
+    lat_vals, lon_vals = ds.lat.values, ds.lon.values
+    lat_min, lat_max = float(lat_vals.min()), float(lat_vals.max())
+    lon_min, lon_max = float(lon_vals.min()), float(lon_vals.max())
+    return Bounds(lat_min, lat_max, lon_min, lon_max, (lat_min + lat_max) / 2, (lon_min + lon_max) / 2)
+
+def image_bounds(da):
+    """Outer cell edges of a regular lat/lon grid as [[south, west], [north, east]]
+
+    Coordinates mark cell centres, so an image overlay spans half a step beyond them.
+    """
+    bounds = []
+    for coord in (da.lat.values, da.lon.values):
+        half = abs(float(coord[1] - coord[0])) / 2 if coord.size > 1 else 0.0
+        bounds.append((float(coord.min()) - half, float(coord.max()) + half))
+    (south, north), (west, east) = bounds
+    return [[south, west], [north, east]]
+
+def within(extent, lat, lon):
+    """Whether coordinates (scalars or arrays) fall inside an `image_bounds` extent"""
+    (south, west), (north, east) = extent
+    return (south <= lat) & (lat <= north) & (west <= lon) & (lon <= east)
+
+def regular_grid(ds):
+    """Regular grid origin/step/size, so nearest points are found arithmetically"""
+    return (float(ds.lat[0]), float(ds.lat[1] - ds.lat[0]), ds.sizes['lat'],
+            float(ds.lon[0]), float(ds.lon[1] - ds.lon[0]), ds.sizes['lon'])
+
+def nearest_ij(lat, lon, grid):
+    """Return the (lat, lon) indices of the grid cells nearest to coordinates (scalars or arrays)
+
+    Ties round up, matching `.sel(method='nearest')` and `nearest_index`.
+    """
+    lat0, dlat, nlat, lon0, dlon, nlon = grid
+    iy = np.clip(np.floor((np.asarray(lat) - lat0) / dlat + 0.5).astype(int), 0, nlat - 1)
+    ix = np.clip(np.floor((np.asarray(lon) - lon0) / dlon + 0.5).astype(int), 0, nlon - 1)
+    return iy, ix
+
+def nearest_index(coords, value):
+    """Index of the entry in ascending `coords` nearest to `value`"""
+    i = int(np.clip(np.searchsorted(coords, value), 1, len(coords) - 1))
+    return i - int((coords[i] - value) > (value - coords[i - 1]))
+
+def coarsen_for_display(da):
+    """Block-average a map to at most ~512 rows; the overlay is only a thumbnail"""
+    factor = max(1, int(da.sizes['lat'] // 512))
+    if factor == 1:
+        return da
+    return da.coarsen(lat=factor, lon=factor, boundary="trim").mean()
+
+def cell_stats(years, flat):
+    """Trend line and NaN-skipping max/min/mean per cell of a (year, cell) array
+
+    The least-squares line is solved in closed form; cells with any missing year get
+    NaN coefficients.
+    """
+    x = np.asarray(years, dtype='float64')
+    xc = x - x.mean()
+    ncell = flat.shape[1]
+    slope = np.full(ncell, np.nan)
+    intercept = np.full(ncell, np.nan)
+    valid = np.isfinite(flat).all(axis=0)
+    cells = flat[:, valid].astype('float64')
+    # Centred years sum to zero, so the slope is one matrix-vector product
+    slope[valid] = xc @ cells / (xc @ xc)
+    intercept[valid] = cells.mean(axis=0) - slope[valid] * x.mean()
+    return {
+        'slope': slope,
+        'intercept': intercept,
+        'max': np.nanmax(flat, axis=0),
+        'min': np.nanmin(flat, axis=0),
+        'mean': np.nanmean(flat, axis=0),
+    }